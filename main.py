@@ -1,52 +1,107 @@
 from fastapi import FastAPI, UploadFile, Form, HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import os, tempfile, shutil, zipfile
-from script import generate_stl_models
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import io, os, tempfile, shutil, zipfile, hashlib
+from functools import lru_cache
+from contextlib import closing
+from script import iter_stl_models, load_districts
 
 app = FastAPI()
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+class DistrictsUpload:
+	# cache key for an uploaded GeoJSON. compares by content hash, path is only where to read it from.
+	def __init__(self, digest: str, path: str):
+		self.digest = digest
+		self.path = path
+
+	def __hash__(self):
+		return hash(self.digest)
+
+	def __eq__(self, other):
+		return isinstance(other, DistrictsUpload) and self.digest == other.digest
+
+# the same districts file tends to be uploaded over and over, keep the parsed GeoDataFrames around.
+@lru_cache(maxsize=16)
+def cached_districts(upload: DistrictsUpload):
+	return load_districts(upload.path)
+
 @app.get("/")
 def hello():
 	return {"message": "Hello world!"}
 
+class ZipStream(io.RawIOBase):
+	# write-only buffer zipfile writes into, drained chunk by chunk into the response.
+	def __init__(self):
+		self.chunks = []
+
+	def writable(self):
+		return True
+
+	def write(self, b):
+		self.chunks.append(bytes(b))
+		return len(b)
+
+	def pop(self) -> bytes:
+		data = b"".join(self.chunks)
+		self.chunks.clear()
+		return data
+
 @app.post("/generate")
 async def generate_stl(geojson: UploadFile, dem: UploadFile, exaggeration: float = Form(10)):
-	#save uploaded files temporarily
-	with tempfile.TemporaryDirectory() as temp_dir:
-		geojson_path = os.path.join(temp_dir, geojson.filename)
-		dem_path = os.path.join(temp_dir, dem.filename)
+	#save uploaded files temporarily, the directory is removed once the response is streamed.
+	temp_dir = tempfile.TemporaryDirectory()
+	streaming = False
+	try:
+		geojson_path = os.path.join(temp_dir.name, geojson.filename)
+		dem_path = os.path.join(temp_dir.name, dem.filename)
 
+		geojson_bytes = await geojson.read()
 		with open(geojson_path, "wb") as f:
-			shutil.copyfileobj(geojson.file, f)
+			f.write(geojson_bytes)
+		digest = hashlib.blake2b(geojson_bytes, digest_size=16).hexdigest()
 		with open(dem_path, "wb") as f:
 			shutil.copyfileobj(dem.file, f)
-		
-		# generate stls
-		output_folder = os.path.join(temp_dir, "stl_output")
-		generate_stl_models(
-			districts_file=geojson_path,
-			dem_file=dem_path,
-			output_folder=output_folder,
-			vertical_exaggeration=exaggeration
-		)
+		# parsing is blocking, keep it off the event loop.
+		districts = await run_in_threadpool(cached_districts, DistrictsUpload(digest, geojson_path))
 
-		# zip the output folder
-		zip_path = os.path.join(temp_dir, "terrain.zip")
-		with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-			for root, _, files in os.walk(output_folder):
-				for file in files:
-					file_path = os.path.join(root, file)
-					arcname = os.path.relpath(file_path, output_folder)
-					zipf.write(file_path, arcname)
-
-		#return zip
-		return FileResponse(
-			path=zip_path,
+		def stream_zip():
+			# zip each stl as soon as it is generated and send it, nothing is staged on disk.
+			# binary STL barely compresses, so store it instead of deflating.
+			# closing() makes sure the remaining districts are cancelled when the client goes away.
+			# districts without an STL are listed in skipped.txt inside the zip, the status is already sent by then.
+			try:
+				out = ZipStream()
+				skipped = []
+				with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as zipf:
+					with closing(iter_stl_models(
+						districts_file=districts,
+						dem_file=dem_path,
+						vertical_exaggeration=exaggeration,
+						skipped=skipped
+					)) as stls:
+						for name, stl in stls:
+							zipf.writestr(f"{name}.stl", stl)
+							yield out.pop()
+					if skipped:
+						zipf.writestr("skipped.txt", "".join(f"{name}: {reason}\n" for name, reason in skipped))
+				yield out.pop()
+			finally:
+				temp_dir.cleanup()
+
+		#return zip. the background task covers a client that disconnects before streaming starts.
+		response = StreamingResponse(
+			stream_zip(),
 			media_type='application/zip',
-			filename='terrain.zip'
+			headers={"Content-Disposition": 'attachment; filename="terrain.zip"'},
+			background=BackgroundTask(temp_dir.cleanup)
 		)
-
-			
\ No newline at end of file
+		streaming = True
+		return response
+	finally:
+		# until the response owns the upload, any failure (e.g. a bad GeoJSON) removes it right away.
+		if not streaming:
+			temp_dir.cleanup()
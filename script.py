@@ -1,142 +1,423 @@
 #!/usr/bin/env python3
+import io
 import os
+import sys
+import traceback
+import multiprocessing
+import threading
 import argparse
 import geopandas as gpd
+import shapely
+from pyproj import Transformer
 import rasterio
-import rasterio.mask
+from rasterio import features
+from rasterio.windows import Window, from_bounds
+from rasterio.vrt import WarpedVRT
+from affine import Affine
 import numpy as np
 import pyvista as pv
-from shapely.geometry import mapping
-from rasterio.warp import calculate_default_transform, reproject, Resampling
-import subprocess
+from rasterio.enums import Resampling
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from contextlib import ExitStack
+
+try:
+	from numba import njit
+except ImportError:  # numba is optional, plain numpy is used without it.
+	njit = None
+
+# worker pool shared by every call, created on first use. see _get_pool.
+_pool = None
+_pool_lock = threading.Lock()
+
+# GDAL settings for reading the DEM: block cache size in MB, multi-threaded decoding and cached file reads.
+GDAL_OPTIONS = {
+	"GDAL_CACHEMAX": 1024,
+	"GDAL_NUM_THREADS": "ALL_CPUS",
+	"VSI_CACHE": True,
+}
+
+def _get_pool() -> ProcessPoolExecutor:
+	# one pool of cpu_count() workers for the whole process, so concurrent web requests don't each start their own.
+	# workers come from a forkserver (spawn where there is none) instead of forking this process, which by then
+	# has GDAL threads running and, under uvicorn, the whole server in it.
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+			_pool = ProcessPoolExecutor(
+				max_workers=os.cpu_count(),
+				mp_context=multiprocessing.get_context(method),
+			)
+		return _pool
+
+
+def _discard_pool(pool: ProcessPoolExecutor):
+	# drop a broken pool so _get_pool creates a new one, unless another call already replaced it.
+	global _pool
+	with _pool_lock:
+		if _pool is pool:
+			_pool = None
+	pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _window_bounds(bounds, transform, width: int, height: int) -> Window:
+	# pixel window covering the given (left, bottom, right, top) bounds, snapped outwards and clipped to the raster.
+	window = from_bounds(*bounds, transform=transform)
+	col_start = max(int(np.floor(window.col_off)), 0)
+	row_start = max(int(np.floor(window.row_off)), 0)
+	col_stop = min(int(np.ceil(window.col_off + window.width)), width)
+	row_stop = min(int(np.ceil(window.row_off + window.height)), height)
+	return Window(col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0))
+
+
+def _print_stride(nrows: int, ncols: int, target_size_mm: float, print_resolution_mm: float) -> int:
+	# keep every stride-th pixel so the longest side has about one vertex per print_resolution_mm.
+	# a printer can't reproduce anything finer, it only makes the STL bigger.
+	if not print_resolution_mm:
+		return 1
+	target_pixels = max(int(target_size_mm / print_resolution_mm), 1)
+	return max(1, max(nrows, ncols) // target_pixels)
+
+
+def _read_district(src, geom, target_size_mm: float, print_resolution_mm: float, fill):
+	# crop of band 1 around geom, pixels outside it set to fill, read straight at print resolution.
+	# returns (arr, xres, yres) with the pixel size of arr, or None when geom covers no DEM pixel with data.
+	window = _window_bounds(geom.bounds, src.transform, src.width, src.height)
+	if window.width == 0 or window.height == 0:
+		return None
+	stride = _print_stride(window.height, window.width, target_size_mm, print_resolution_mm)
+	out_shape = (-(-window.height // stride), -(-window.width // stride))
+	arr = src.read(1, window=window, out_shape=out_shape)
+	x_step = window.width / out_shape[1]
+	y_step = window.height / out_shape[0]
+	transform = src.window_transform(window) * Affine.scale(x_step, y_step)
+	inside = features.geometry_mask([geom], out_shape=out_shape, transform=transform, invert=True)
+	# the district needs at least one real elevation, otherwise there is nothing to fill no data pixels with.
+	# covers districts in a coverage gap of the DEM or outside the source of a WarpedVRT.
+	valid = inside
+	if src.nodata is not None:
+		valid = valid & (arr != src.nodata)
+	if arr.dtype.kind == "f":
+		valid = valid & ~np.isnan(arr)
+	if not valid.any():
+		return None
+	xres, yres = src.res
+	return np.where(inside, arr, fill), xres * x_step, yres * y_step
+
+
+def _fix_and_scale_numpy(arr: np.ndarray, nodata, vscale: float) -> np.ndarray:
+	# one mask of no data pixels (NaN counts too), filled with the lowest valid elevation.
+	mask = arr == nodata
+	# STL stores float32 coords anyway, so halve the bytes pushed through VTK. always a copy,
+	# the fill and scale below write into it and must not touch the caller's array (same as the numba kernel).
+	arr = arr.astype(np.float32)
+	mask |= np.isnan(arr)
+	if mask.any():
+		arr[mask] = arr[~mask].min()
+	arr *= np.float32(vscale)
+	return arr
+
+
+if njit is not None:
+	# fastmath without the nnan/ninf flags, the kernel relies on v == v to spot NaN pixels.
+	# serial on purpose: it runs inside pool workers, which already take one core each.
+	@njit(fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, cache=True)
+	def _fix_and_scale_numba(arr, nodata, vscale):
+		# same as _fix_and_scale_numpy in two passes over arr: lowest valid elevation, then fill and scale.
+		# NaN pixels count as no data too, like nan_to_num did. _read_district guarantees a valid pixel.
+		nrows, ncols = arr.shape
+		mn = np.inf
+		for i in range(nrows):
+			for j in range(ncols):
+				v = arr[i, j]
+				if v != nodata and v == v:
+					mn = min(mn, v)
+		out = np.empty((nrows, ncols), dtype=np.float32)
+		for i in range(nrows):
+			for j in range(ncols):
+				v = arr[i, j]
+				if v != nodata and v == v:
+					out[i, j] = v * vscale
+				else:
+					out[i, j] = mn * vscale
+		return out
+
+
+def _fix_and_scale(arr: np.ndarray, nodata, vscale: float) -> np.ndarray:
+	# float32 elevations with no data filled in and multiplied by vscale. uses the numba kernel when available.
+	# arr must contain at least one pixel that is neither nodata nor NaN.
+	if njit is None:
+		return _fix_and_scale_numpy(arr, nodata, vscale)
+	return _fix_and_scale_numba(arr, np.nan if nodata is None else float(nodata), float(vscale))
+
+
+# binary STL triangle record: facet normal, three vertices, attribute byte count. 50 bytes, no padding.
+_STL_DTYPE = np.dtype([
+	("normal", "<f4", (3,)),
+	("v1", "<f4", (3,)),
+	("v2", "<f4", (3,)),
+	("v3", "<f4", (3,)),
+	("attr", "<u2"),
+])
+# triangles per block when writing STL, 256K triangles keeps each block's arrays around L2 size.
+_STL_CHUNK = 262144
+
+
+def _write_binary_stl(f, points: np.ndarray, triangles: np.ndarray):
+	# write triangles (indices into points, shape (n, 3)) as binary STL to the binary file object f,
+	# without going through VTK's writer. done in blocks so the temporaries stay cache sized.
+	f.write(b"\0" * 80)
+	f.write(np.uint32(len(triangles)).tobytes())
+
+	buf = np.empty(min(len(triangles), _STL_CHUNK), dtype=_STL_DTYPE)
+	buf["attr"] = 0
+	for start in range(0, len(triangles), _STL_CHUNK):
+		block = triangles[start:start + _STL_CHUNK]
+		out = buf[:len(block)]
+		p1 = points[block[:, 0]]
+		p2 = points[block[:, 1]]
+		p3 = points[block[:, 2]]
+		normals = np.cross(p2 - p1, p3 - p1)
+		lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+		# degenerate triangles keep a zero normal instead of NaN.
+		np.divide(normals, lengths, out=normals, where=lengths > 0)
+
+		out["normal"] = normals
+		out["v1"] = p1
+		out["v2"] = p2
+		out["v3"] = p3
+		f.write(out.data)
+
+
+def _grid_faces(nrows: int, ncols: int) -> np.ndarray:
+	# VTK faces array for a row-major nrows x ncols grid of points, every quad split into two triangles.
+	# a is the top-left corner of each quad, b its right neighbour, c the one below, d diagonal.
+	a = np.add.outer(np.arange(nrows - 1) * ncols, np.arange(ncols - 1)).ravel()
+	# filled in place, row k of each half is [3, i, j, k] for one triangle.
+	faces = np.empty((2, a.size, 4), dtype=np.int64)
+	faces[:, :, 0] = 3
+	faces[:, :, 1] = a
+	faces[0, :, 2] = a + 1
+	faces[0, :, 3] = a + ncols + 1
+	faces[1, :, 2] = a + ncols + 1
+	faces[1, :, 3] = a + ncols
+	return faces.ravel()
+
+
+def _process_district(
+	arr: np.ndarray,
+	xres: float,
+	yres: float,
+	nodata: float,
+	vertical_exaggeration: float,
+	target_size_mm: float,
+) -> bytes:
+	# runs in a worker process, returns the binary STL. arr is the district's crop of the DEM, pixels outside the district are already nodata.
+	# create mesh for this district
+	nrows, ncols = arr.shape
+
+	# scaling. model is now in milimeters.
+	max_dim_m = max(ncols * xres, nrows * yres)
+	scale = target_size_mm / (max_dim_m * 1000.0)
+
+	# 1d coords of each pixel column/row, scale folded into the step so there is no per-pixel multiply.
+	x = (np.arange(ncols, dtype=np.float32) * (xres * scale * 1000))[None, :]
+	y = (np.arange(nrows, dtype=np.float32) * (yres * scale * 1000))[:, None]
+	# the point array needs full 2d arrays, so only expand the broadcast views here.
+	X = np.broadcast_to(x, arr.shape).copy()
+	Y = np.broadcast_to(y, arr.shape).copy()
+	# replace no data pixels with the lowest point of elevation, add vertical exageration and scaling.
+	Z = _fix_and_scale(arr, nodata, vertical_exaggeration * scale * 1000)
+
+	# create triangle mesh. the grid is regular, so split every pixel quad into two triangles directly
+	# instead of going through StructuredGrid.extract_surface().triangulate().
+	points = np.column_stack([X.ravel(), Y.ravel(), Z.ravel()])
+	mesh = pv.PolyData(points, _grid_faces(nrows, ncols))
+	# --- add solid base ---
+	zmin = float(Z.min())
+
+	# Terrain surface
+	surface = mesh
+
+	# Extract boundary edges and extrude them down
+	edges = surface.extract_feature_edges(boundary_edges=True)
+	walls = edges.extrude((0, 0, zmin - surface.points[:, 2].min())).triangulate()
+
+	# Flat base
+	base = pv.Plane(
+		center=((X.max() + X.min()) / 2, (Y.max() + Y.min()) / 2, zmin),
+		i_size=X.max() - X.min(),
+		j_size=Y.max() - Y.min(),
+		i_resolution=1,
+		j_resolution=1,
+	).triangulate()
+
+	# Merge into one closed solid
+	solid = surface.merge(walls).merge(base)
+
+	# Solid STL. every cell is a triangle, so the faces array is rows of [3, i, j, k].
+	stl = io.BytesIO()
+	_write_binary_stl(stl, solid.points, solid.faces.reshape(-1, 4)[:, 1:])
+	return stl.getvalue()
+
+
+def _to_crs(gdf: gpd.GeoDataFrame, crs: str) -> gpd.GeoDataFrame:
+	# same as gdf.to_crs, but the vertices of all districts go through PROJ in a single array call.
+	if gdf.crs is None or gdf.crs == crs:
+		return gdf.to_crs(crs)
+	transformer = Transformer.from_crs(gdf.crs, crs, always_xy=True)
+
+	def project(coords):
+		x, y = transformer.transform(coords[:, 0], coords[:, 1])
+		return np.column_stack([x, y])
+
+	gdf = gdf.copy()
+	gdf[gdf.geometry.name] = shapely.transform(np.asarray(gdf.geometry.values), project)
+	return gdf.set_crs(crs, allow_override=True)
+
+
+def _skip(name: str, reason: str, skipped: list = None):
+	print(f"Skipping {name}: {reason}", file=sys.stderr)
+	if skipped is not None:
+		skipped.append((name, reason))
+
+
+def _finished(futures: dict, skipped: list = None):
+	# waits for at least one of futures (future -> district name) and yields (name, STL bytes) of the ones done.
+	# done futures are removed, so their STL is released as soon as the caller is done with it.
+	done, _ = wait(futures, return_when=FIRST_COMPLETED)
+	for future in done:
+		name = futures.pop(future)
+		try:
+			stl = future.result()
+		except BrokenProcessPool:
+			# a worker died (segfault, OOM killer), that is the pool failing, not this district.
+			raise
+		except Exception:
+			# one broken district shouldn't take the others down (or cut a streamed zip short), report and move on.
+			traceback.print_exc()
+			_skip(name, "generating the STL failed", skipped)
+			continue
+		yield name, stl
+
+
+def load_districts(districts_file, target_epsg: int = None) -> gpd.GeoDataFrame:
+	# districts_file is a path, or a GeoDataFrame that is already loaded. reprojected to target_epsg if given.
+	if isinstance(districts_file, gpd.GeoDataFrame):
+		gdf = districts_file
+	else:
+		# pyogrio reads the whole file through arrow instead of feature by feature like fiona.
+		gdf = gpd.read_file(districts_file, engine="pyogrio", use_arrow=True)
+	if target_epsg is not None:
+		gdf = _to_crs(gdf, f"EPSG:{target_epsg}")
+	return gdf
+
+
+def iter_stl_models(
+	districts_file,  # path to the districts GeoJSON, or a GeoDataFrame from load_districts.
+	dem_file: str,
+	vertical_exaggeration: float = 10,
+	target_size_mm: float = 180,
+	target_epsg: int = None,  # optional EPSG for reprojection
+	print_resolution_mm: float = 0.15,  # spacing between vertices on the print, 0 or None keeps every DEM pixel.
+	skipped: list = None,  # if given, (name, reason) of every district that gets no STL is appended to it.
+):
+	# yields (district name, binary STL bytes) for every district, in the order they finish.
+	# Load and reproject districts file to desired crs.
+	gdf = load_districts(districts_file, target_epsg)
+	target_crs = f"EPSG:{target_epsg}" if target_epsg is not None else None
+	# assigns name of district, tries finding column "shapeName", change if different.
+	if "shapeName" in gdf.columns:
+		names = gdf["shapeName"].tolist()
+	else:
+		names = [f"district_{idx}" for idx in gdf.index]
+	# visit districts along a Hilbert curve so neighbours are read back to back and reuse GDAL's cached tiles.
+	order = np.argsort(gdf.geometry.hilbert_distance().to_numpy(), kind="stable")
+	names = [names[i] for i in order]
+	geoms = gdf.geometry.values[order]
+
+	process = partial(
+		_process_district,
+		vertical_exaggeration=vertical_exaggeration,
+		target_size_mm=target_size_mm,
+	)
+
+	# districts are independent, mesh them in parallel. main loop
+	ex = _get_pool()
+	futures = {}
+	# enough crops queued to keep every worker busy, without reading every district ahead of them.
+	max_pending = 2 * (os.cpu_count() or 1)
+	try:
+		# open the DEM (digital elevation model) once and read only the window around each district.
+		# GDAL decodes tiles on all cores and keeps them cached between neighbouring districts.
+		# the Env is entered around the open and each read rather than held: the generator yields in between
+		# and may be resumed on another thread (StreamingResponse), while rasterio's env is thread-local.
+		with ExitStack() as stack:
+			with rasterio.Env(**GDAL_OPTIONS):
+				src = stack.enter_context(rasterio.open(dem_file))
+				if target_crs is not None and src.crs.to_string() != target_crs:
+					# warp on the fly, only the windows read below get reprojected and nothing is written to disk.
+					print(f"Reprojecting DEM to {target_crs}...")
+					src = stack.enter_context(WarpedVRT(src, crs=target_crs, resampling=Resampling.bilinear))
+			nodata = src.nodata
+			# rasterio.mask used to fill outside pixels with nodata, or 0 when the DEM has none.
+			fill = nodata if nodata is not None else 0
+
+			for name, geom in zip(names, geoms):
+				with rasterio.Env(**GDAL_OPTIONS):
+					district = _read_district(src, geom, target_size_mm, print_resolution_mm, fill)
+				if district is None:
+					_skip(name, "district does not overlap the DEM data", skipped)
+					continue
+				arr, xres, yres = district
+				futures[ex.submit(process, arr, xres, yres, nodata)] = name
+				while len(futures) >= max_pending:
+					yield from _finished(futures, skipped)
+
+		while futures:
+			yield from _finished(futures, skipped)
+	except BrokenProcessPool:
+		# a dead worker breaks the executor for good, let the next call start a fresh pool.
+		_discard_pool(ex)
+		raise
+	finally:
+		# the pool is shared, so only drop this call's districts that haven't started yet when the caller stops
+		# early (client gone, exception). everything still in futures is unfinished.
+		for future in futures:
+			future.cancel()
+
 
 def generate_stl_models(
-	districts_file: str,
+	districts_file,  # path to the districts GeoJSON, or a GeoDataFrame from load_districts.
 	dem_file: str,
 	output_folder: str = "stl_districts",  # default value, if not specified program creates "stl_districts" in the folder it was run in.
 	vertical_exaggeration: float = 10,
 	target_size_mm: float = 180,
 	target_epsg: int = None,  # optional EPSG for reprojection
+	print_resolution_mm: float = 0.15,  # spacing between vertices on the print, 0 or None keeps every DEM pixel.
 ):
+	# returns (name, reason) of every district that got no STL.
 	# create folder for output, if exists, don't create
 	os.makedirs(output_folder, exist_ok=True)
 
-	processed_dem_file = dem_file
-	if target_epsg is not None:
-		target_crs = f"EPSG:{target_epsg}"
-		
-		# Check DEM's current CRS
-		with rasterio.open(dem_file) as src:
-			dem_crs = src.crs
-		
-		if dem_crs.to_string() != target_crs:
-			print(f"Reprojecting DEM to {target_crs} using gdalwarp...")
-			
-			# Construct the gdalwarp command with variables
-			temp_dem_name = f"reprojected_dem_{target_epsg}.tif"
-			command = ["gdalwarp", "-t_srs", target_crs, dem_file, temp_dem_name]
-			
-			# Execute the command
-			try:
-				subprocess.run(command, check=True, capture_output=True, text=True)
-				processed_dem_file = temp_dem_name
-				print("Reprojection successful.")
-			except subprocess.CalledProcessError as e:
-				print(f"Error during gdalwarp execution: {e.stderr}")
-				return # Exit if reprojection fails
-
-	# Load and reproject districts file to desired crs.
-	gdf = gpd.read_file(districts_file)
-	if target_epsg is not None:
-		target_crs = f"EPSG:{target_epsg}"
-		gdf = gdf.to_crs(target_crs)
-	# iterate over districts. main loop
-	for idx, row in gdf.iterrows():
-		# assigns name of district, tries finding column "shapeName", change if different.
-		name = row.get("shapeName", f"district_{idx}")
-		# convert from shapely object to dictionary.
-		geom = [mapping(row["geometry"])]
-
-		# open the DEM (digital elevation model)
-		with rasterio.open(processed_dem_file) as src:
-			if target_epsg is not None and src.crs.to_string() != f"EPSG:{target_epsg}":
-				# crop DEM(src) to the boundaries of the districts geometry(geom).
-				out_image, out_transform = rasterio.mask.mask(
-					src, geom, crop=True, all_touched=True, nodata=src.nodata
-				)
-				dst_crs = f"EPSG:{target_epsg}"
-				dst_array = np.empty_like(out_image)
-
-				reproject(
-					source=out_image,
-					destination=dst_array,
-					src_transform=src.transform,
-					src_crs=src.crs,
-					dst_transform=out_transform,
-					dst_crs=dst_crs,
-					resampling=Resampling.bilinear
-				)
-				arr = dst_array[0]
-			else: # no reprojection is needed.
-				out_image, _ = rasterio.mask.mask(src, geom, crop=True)
-				arr = out_image[0]
-
-		# find no data pixels and replace with NaN, then replace NaN with the lowest point of elevation.
-		arr = np.where(arr == src.nodata, np.nan, arr)
-		arr = np.nan_to_num(arr, nan=np.nanmin(arr))
-
-		# create mesh for this district
-		nrows, ncols = arr.shape
-		xres, yres = src.res
-		# create 2 2d arrays, x and y. they represent coords of each pixel in the grid.
-		X, Y = np.meshgrid(np.arange(ncols) * xres, np.arange(nrows) * yres)
-		# add vertical exageration.
-		Z = arr * vertical_exaggeration
-
-		# scaling. model is now in milimeters.
-		max_dim_m = max(ncols * xres, nrows * yres)
-		scale = target_size_mm / (max_dim_m * 1000.0)
-		X *= scale * 1000
-		Y *= scale * 1000
-		Z *= scale * 1000
-
-		grid = pv.StructuredGrid(X, Y, Z)
-		# create triangle mesh
-		mesh = grid.extract_surface().triangulate()
-		# --- add solid base ---
-		zmin = float(Z.min())
-
-		# Terrain surface
-		surface = mesh
-
-		# Extract boundary edges and extrude them down
-		edges = surface.extract_feature_edges(boundary_edges=True)
-		walls = edges.extrude((0, 0, zmin - surface.points[:, 2].min()))
-
-		# Flat base
-		base = pv.Plane(
-			center=((X.max() + X.min()) / 2, (Y.max() + Y.min()) / 2, zmin),
-			i_size=X.max() - X.min(),
-			j_size=Y.max() - Y.min(),
-			i_resolution=1,
-			j_resolution=1,
-		).triangulate()
-
-		# Merge into one closed solid
-		solid = surface.merge(walls).merge(base)
-		
+	skipped = []
+	for name, stl in iter_stl_models(
+		districts_file,
+		dem_file,
+		vertical_exaggeration=vertical_exaggeration,
+		target_size_mm=target_size_mm,
+		target_epsg=target_epsg,
+		print_resolution_mm=print_resolution_mm,
+		skipped=skipped,
+	):
 		# Path for STL
 		stl_path = os.path.join(output_folder, f"{name}.stl")
-
-		# Save solid STL
-		solid.save(stl_path)
+		with open(stl_path, "wb") as f:
+			f.write(stl)
 		print(f"Saved {stl_path}")
-
-		
-	 # clean up the temporary DEM file
-	if processed_dem_file != dem_file:
-		os.remove(processed_dem_file)
-		print(f"Removed temporary file: {processed_dem_file}")
+	return skipped
 
 
 def parse_args():
@@ -148,15 +429,21 @@ def parse_args():
 	parser.add_argument("--scale", "-s", type=float, default=180, help="Target size in mm for longest side")
 	parser.add_argument("--epsg", "-c", type=int, default=None,
 						help="EPSG code to reproject DEM and districts to (optional)")
+	parser.add_argument("--resolution", "-r", type=float, default=0.15,
+						help="Vertex spacing in mm on the print, 0 keeps every DEM pixel")
 	return parser.parse_args()
 
 if __name__ == "__main__":
 	args = parse_args()
-	generate_stl_models(
+	skipped = generate_stl_models(
 		districts_file=args.districts_file,
 		dem_file=args.dem_file,
 		output_folder=args.output,
 		vertical_exaggeration=args.exaggeration,
 		target_size_mm=args.scale,
-		target_epsg=args.epsg
+		target_epsg=args.epsg,
+		print_resolution_mm=args.resolution
 	)
+	if skipped:
+		print(f"{len(skipped)} district(s) got no STL: {', '.join(name for name, _ in skipped)}", file=sys.stderr)
+		sys.exit(1)